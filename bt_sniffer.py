@@ -1,17 +1,53 @@
 import argparse
 import asyncio
 import csv
+import functools
 import json
+import os
 import sys
 import time
 import platform
+import stat
 from datetime import datetime, timezone
 
 
 def utc_now_iso():
     return datetime.now(timezone.utc).isoformat()
 
+# (epoch seconds, iso string) of the last formatted timestamp. Rebound as a
+# whole tuple so threads (BLE loop + Classic worker) never see a torn pair.
+_LAST_TS_CACHE = (0.0, "")
+_TS_CACHE_WINDOW = 0.1
+
+#Like utc_now_iso(), but reuses the previous string for up to 100 ms.
+#Used for last_seen, which is refreshed on every advertisement.
+def utc_now_iso_cached():
+    global _LAST_TS_CACHE
+    t = time.time()
+    t0, iso = _LAST_TS_CACHE
+    # A wall clock stepped backwards (NTP) invalidates the cache too
+    if 0 <= t - t0 < _TS_CACHE_WINDOW:
+        return iso
+    iso = datetime.fromtimestamp(t, timezone.utc).isoformat()
+    _LAST_TS_CACHE = (t, iso)
+    return iso
+
+# Export column order: CSV header, DeviceRecord.to_values() order and to_row() keys
+_FIELDS = (
+    "address","transport","name","rssi","tx_power","appearance","connectable",
+    "address_type","device_class","service_uuids","service_data","manufacturer_data",
+    "first_seen","last_seen","sightings",
+)
+# Columns holding lists/dicts, JSON-encoded for CSV
+_NESTED_FIELDS = tuple(_FIELDS.index(k) for k in ("service_uuids", "service_data", "manufacturer_data"))
+
 class DeviceRecord:
+    __slots__ = (
+        "address", "transport", "name", "rssi", "tx_power", "appearance", "connectable",
+        "address_type", "service_uuids", "service_data", "manufacturer_data", "device_class",
+        "first_seen", "last_seen", "sightings",
+    )
+
     def __init__(self, address, transport):
         self.address = address
         self.transport = transport  # "BLE" or "Classic"
@@ -21,19 +57,42 @@ class DeviceRecord:
         self.appearance = None
         self.connectable = None
         self.address_type = None
-        self.service_uuids = set()
-        self.service_data = {}      # uuid -> hex string
-        self.manufacturer_data = {} # company_id(int) -> hex string
+        self.service_uuids = {}     # uuid -> None, ordered by first sighting
+        self.service_data = {}      # uuid -> raw bytes, hex-encoded by to_row()
+        self.manufacturer_data = {} # company_id(int) -> raw bytes, hex-encoded by to_row()
         self.device_class = None    # Classic CoD integer if available
         self.first_seen = utc_now_iso()
         self.last_seen = self.first_seen
         self.sightings = 0
 
     def update_last_seen(self):
-        self.last_seen = utc_now_iso()
+        # The cached stamp may predate an exact first_seen taken moments ago.
+        # Clamp against first_seen only, so a clock stepped backwards still updates last_seen.
+        ts = utc_now_iso_cached()
+        self.last_seen = ts if ts > self.first_seen else self.first_seen
         self.sightings += 1
     
-#This method return a flat dictionary that is suitable for CSV/JOSN.
+#Same values as to_row(), as a tuple in _FIELDS order, for the CSV writer.
+    def to_values(self):
+        return (
+            self.address,
+            self.transport,
+            self.name,
+            self.rssi,
+            self.tx_power,
+            self.appearance,
+            self.connectable,
+            self.address_type,
+            self.device_class,
+            list(self.service_uuids) or None,
+            {u: b.hex() for u, b in self.service_data.items()} or None,
+            {cid: b.hex() for cid, b in self.manufacturer_data.items()} or None,
+            self.first_seen,
+            self.last_seen,
+            self.sightings,
+        )
+
+#This method return a flat dictionary that is suitable for JSON.
     def to_row(self):
         return {
             "address": self.address,
@@ -45,17 +104,68 @@ class DeviceRecord:
             "connectable": self.connectable,
             "address_type": self.address_type,
             "device_class": self.device_class,
-            "service_uuids": sorted(list(self.service_uuids)) if self.service_uuids else None,
-            "service_data": self.service_data or None,
-            "manufacturer_data": self.manufacturer_data or None,
+            "service_uuids": list(self.service_uuids) or None,
+            "service_data": {u: b.hex() for u, b in self.service_data.items()} or None,
+            "manufacturer_data": {cid: b.hex() for cid, b in self.manufacturer_data.items()} or None,
             "first_seen": self.first_seen,
             "last_seen": self.last_seen,
             "sightings": self.sightings,
         }
 
+# to_row() keys and to_values() positions must both follow _FIELDS. The probe
+# gets a distinct value per field so a swapped column fails the check.
+_probe = DeviceRecord("address", "transport")
+for _k in ("name", "rssi", "tx_power", "appearance", "connectable", "address_type",
+           "device_class", "first_seen", "last_seen", "sightings"):
+    setattr(_probe, _k, _k)
+_probe.service_uuids = {"service_uuids": None}
+_probe.service_data = {"service_data": b"\x01"}
+_probe.manufacturer_data = {0: b"\x02"}
+assert tuple(_probe.to_row()) == _FIELDS
+assert tuple(_probe.to_row().values()) == _probe.to_values()
+del _probe, _k
+
+#Address -> DeviceRecord map that creates the BLE record on first lookup,
+#so the detection callback needs a single dict access per advertisement.
+class _RecordMap(dict):
+    def __missing__(self, addr):
+        rec = DeviceRecord(addr, "BLE")
+        self[addr] = rec
+        return rec
+
 #BLE scan implementation (bleak)
 
-async def scan_ble(duration, adapter, verbose=False):
+#Copy the fields of one bleak AdvertisementData into its DeviceRecord.
+def _apply_advertisement(rec, device, adv_data):
+    # Update high-level fields. local_name/rssi/tx_power and the payload
+    # dicts are fixed AdvertisementData fields; the rest are backend extras.
+    rec.name = device.name or adv_data.local_name or rec.name
+    rssi = adv_data.rssi
+    rec.rssi = rssi if rssi is not None else getattr(device, "rssi", None)
+    rec.tx_power = adv_data.tx_power
+    rec.appearance = getattr(adv_data, "appearance", None)
+    rec.connectable = getattr(adv_data, "connectable", None)
+    rec.address_type = getattr(adv_data, "address_type", None)
+
+    # Service UUIDs
+    svc_uuids = adv_data.service_uuids
+    if svc_uuids:
+        for u in svc_uuids:
+            rec.service_uuids[u] = None
+
+    # Service data (uuid -> bytes). Payloads are kept raw because beacons
+    # re-broadcast the same bytes constantly; to_row() hex-encodes them.
+    svc_data = adv_data.service_data
+    if svc_data:
+        rec.service_data.update(svc_data)
+
+    # Manufacturer data (company_id -> bytes)
+    mfr_data = adv_data.manufacturer_data
+    if mfr_data:
+        # bleak already keys manufacturer data by int company_id
+        rec.manufacturer_data.update(mfr_data)
+
+async def scan_ble(duration, adapter, verbose=False, service_uuids=None, passive=False):
     try:
         from bleak import BleakScanner
         from bleak.backends.scanner import AdvertisementData
@@ -64,53 +174,37 @@ async def scan_ble(duration, adapter, verbose=False):
         print("    pip install bleak", file=sys.stderr)
         return {}
 
-    records = {}
+    records = _RecordMap()
 
-    def on_detect(device, adv_data: 'AdvertisementData'):
-        addr = getattr(device, "address", None) or getattr(device, "mac_address", None) or "UNKNOWN"
-        rec = records.get(addr)
-        if rec is None:
-            rec = DeviceRecord(addr, "BLE")
-            records[addr] = rec
+    # Free names are bound as defaults so the hot callback reads them as fast locals
+    def on_detect(device, adv_data: 'AdvertisementData',
+                  _records=records, _apply=_apply_advertisement, _getattr=getattr):
+        addr = _getattr(device, "address", None) or _getattr(device, "mac_address", None) or "UNKNOWN"
+        rec = _records[addr]
 
-        # Update high-level fields
-        rec.name = device.name or adv_data.local_name or rec.name
-        rec.rssi = getattr(adv_data, "rssi", None) if getattr(adv_data, "rssi", None) is not None else getattr(device, "rssi", None)
-        rec.tx_power = getattr(adv_data, "tx_power", None)
-        rec.appearance = getattr(adv_data, "appearance", None)
-        rec.connectable = getattr(adv_data, "connectable", None)
-        rec.address_type = getattr(adv_data, "address_type", None)
-
-        # Service UUIDs
-        if getattr(adv_data, "service_uuids", None):
-            for u in adv_data.service_uuids:
-                rec.service_uuids.add(u)
-
-        # Service data (uuid -> hex)
-        if getattr(adv_data, "service_data", None):
-            for u, b in adv_data.service_data.items():
-                rec.service_data[u] = b.hex()
-
-        # Manufacturer data (company_id -> hex)
-        if getattr(adv_data, "manufacturer_data", None):
-            for cid, b in adv_data.manufacturer_data.items():
-                try:
-                    key = int(cid)
-                except Exception:
-                    key = cid
-                rec.manufacturer_data[key] = b.hex()
+        _apply(rec, device, adv_data)
 
         rec.update_last_seen()
-        if verbose:
-            print(f"[BLE] {rec.address}  RSSI={rec.rssi}  Name={rec.name}  Services={len(rec.service_uuids)}")
+        return rec
+
+    # Picked once here so the non-verbose hot path carries no logging branch
+    def on_detect_verbose(device, adv_data: 'AdvertisementData', _on_detect=on_detect):
+        rec = _on_detect(device, adv_data)
+        print(f"[BLE] {rec.address}  RSSI={rec.rssi}  Name={rec.name}  Services={len(rec.service_uuids)}")
 
     kwargs = {}
     # Adapter selection (Linux 'hci0', macOS None, Windows None)
     if adapter:
         kwargs["adapter"] = adapter
+    # BlueZ and CoreBluetooth filter in the OS stack; bleak's WinRT backend filters in Python,
+    # but either way unwanted advertisements never reach on_detect
+    if service_uuids:
+        kwargs["service_uuids"] = service_uuids
+    if passive:
+        kwargs["scanning_mode"] = "passive"
 
     try:
-        scanner = BleakScanner(detection_callback=on_detect, **kwargs)
+        scanner = BleakScanner(detection_callback=on_detect_verbose if verbose else on_detect, **kwargs)
         await scanner.start()
         await asyncio.sleep(duration)
         await scanner.stop()
@@ -162,31 +256,75 @@ def scan_classic(duration, verbose=False):
 
 #Output helpers
 
+# Large write buffer so per-record writes coalesce into a few big syscalls
+_WRITE_BUFFER = 1 << 20
+
+#Flush and fsync an output file so a finished scan log survives a crash or power loss.
+#Pipes, ttys and other non-regular outputs (e.g. /dev/stdout) cannot be fsynced and are only flushed.
+def _sync(f):
+    f.flush()
+    fd = f.fileno()
+    if stat.S_ISREG(os.fstat(fd).st_mode):
+        os.fsync(fd)
+
 def write_json(path, records):
-    with open(path, "w", encoding="utf-8") as f:
-        json.dump([r.to_row() for r in records.values()], f, ensure_ascii=False, indent=2)
+    # Records are encoded one at a time so the full row list is never held in memory.
+    # Each one is re-indented by two spaces to keep json.dump(rows, indent=2)'s layout;
+    # encoded JSON never contains a raw newline, so replacing them is safe.
+    try:
+        import orjson  # Optional, much faster encoder
+    except Exception:
+        with open(path, "w", encoding="utf-8", buffering=_WRITE_BUFFER) as f:
+            if not records:
+                f.write("[]")
+            else:
+                f.write("[\n")
+                for i, rec in enumerate(records.values()):
+                    if i:
+                        f.write(",\n")
+                    f.write("  " + json.dumps(rec.to_row(), ensure_ascii=False, indent=2).replace("\n", "\n  "))
+                f.write("\n]")
+            _sync(f)
+        return
+
+    # orjson emits UTF-8 bytes; OPT_NON_STR_KEYS covers int company_id keys
+    opts = orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS
+    with open(path, "wb", buffering=_WRITE_BUFFER) as f:
+        if not records:
+            f.write(b"[]")
+        else:
+            f.write(b"[\n")
+            for i, rec in enumerate(records.values()):
+                if i:
+                    f.write(b",\n")
+                f.write(b"  " + orjson.dumps(rec.to_row(), option=opts).replace(b"\n", b"\n  "))
+            f.write(b"\n]")
+        _sync(f)
 
 def write_csv(path, records):
-    rows = [r.to_row() for r in records.values()]
-    # Expand sets/lists/dicts to JSON strings for CSV
-    for r in rows:
-        if isinstance(r.get("service_uuids"), list):
-            r["service_uuids"] = json.dumps(r["service_uuids"])
-        if isinstance(r.get("service_data"), dict):
-            r["service_data"] = json.dumps(r["service_data"])
-        if isinstance(r.get("manufacturer_data"), dict):
-            r["manufacturer_data"] = json.dumps(r["manufacturer_data"])
-
-    fieldnames = [
-        "address","transport","name","rssi","tx_power","appearance","connectable",
-        "address_type","device_class","service_uuids","service_data","manufacturer_data",
-        "first_seen","last_seen","sightings"
-    ]
-    with open(path, "w", newline="", encoding="utf-8") as f:
-        w = csv.DictWriter(f, fieldnames=fieldnames)
-        w.writeheader()
-        for r in rows:
-            w.writerow(r)
+    try:
+        import orjson  # Optional, much faster encoder
+
+        def dumps(v):
+            return orjson.dumps(v, option=orjson.OPT_NON_STR_KEYS).decode()
+    except Exception:
+        # Match orjson's compact output so CSV cells don't depend on what is installed
+        dumps = functools.partial(json.dumps, ensure_ascii=False, separators=(",", ":"))
+
+    def gen_rows():
+        for rec in records.values():
+            row = list(rec.to_values())
+            # Expand lists/dicts to JSON strings for CSV
+            for i in _NESTED_FIELDS:
+                if row[i] is not None:
+                    row[i] = dumps(row[i])
+            yield row
+
+    with open(path, "w", newline="", encoding="utf-8", buffering=_WRITE_BUFFER) as f:
+        w = csv.writer(f)
+        w.writerow(_FIELDS)
+        w.writerows(gen_rows())
+        _sync(f)
 
 #CLI Design for the program.
 
@@ -200,7 +338,25 @@ def parse_args():
     p.add_argument("--json", dest="json_path", type=str, default=None, help="Write results to JSON file path.")
     p.add_argument("--csv", dest="csv_path", type=str, default=None, help="Write results to CSV file path.")
     p.add_argument("--verbose", action="store_true", help="Print sightings as they arrive.")
-    return p.parse_args()
+    p.add_argument("--filter-service-uuid", dest="filter_service_uuids", action="append", default=None,
+                   metavar="UUID",
+                   help="Only report BLE devices advertising this 128-bit service UUID (repeatable). "
+                        "Filtered by the OS Bluetooth stack on Linux/macOS, by bleak on Windows.")
+    p.add_argument("--passive", action="store_true",
+                   help="Use passive BLE scanning (no scan requests sent). Windows only.")
+    p.add_argument("--parallel-both", action="store_true",
+                   help="With --mode both, run BLE and Classic scans at the same time. "
+                        "Only use this if your adapter(s) can scan both transports concurrently.")
+    args = p.parse_args()
+    if args.parallel_both and args.mode != "both":
+        p.error("--parallel-both requires --mode both")
+    # bleak raises for passive mode on macOS, and on BlueZ it needs advertisement
+    # monitor or_patterns (and then ignores service_uuids), which are not exposed here
+    if args.mode == "classic" and (args.filter_service_uuids or args.passive):
+        p.error("--filter-service-uuid and --passive only apply to BLE scans (--mode ble or both)")
+    if args.passive and platform.system() != "Windows":
+        p.error("--passive is only supported on Windows")
+    return args
 
 async def main_async():
     args = parse_args()
@@ -210,15 +366,24 @@ async def main_async():
     print(f"[i] Mode: {args.mode}  Duration: {args.seconds}s per mode  Adapter: {args.adapter or '(default)'}")
     print(f"[i] Started at: {utc_now_iso()}")
 
+    classic_records = None
     if args.mode in ("ble", "both"):
-        print("[i] Starting BLE scan...")
-        ble_records = await scan_ble(args.seconds, args.adapter, verbose=args.verbose)
+        ble_scan = scan_ble(args.seconds, args.adapter, verbose=args.verbose,
+                            service_uuids=args.filter_service_uuids, passive=args.passive)
+        if args.parallel_both:  # parse_args only allows this with --mode both
+            print("[i] Starting BLE and Classic Inquiry scans in parallel...")
+            ble_records, classic_records = await asyncio.gather(
+                ble_scan, asyncio.to_thread(scan_classic, args.seconds, args.verbose))
+        else:
+            print("[i] Starting BLE scan...")
+            ble_records = await ble_scan
         all_records.update(ble_records)
         print(f"[i] BLE scan complete: {len(ble_records)} device(s)")
 
     if args.mode in ("classic", "both"):
-        print("[i] Starting Classic Inquiry scan...")
-        classic_records = await asyncio.to_thread(scan_classic, args.seconds, args.verbose)
+        if classic_records is None:
+            print("[i] Starting Classic Inquiry scan...")
+            classic_records = await asyncio.to_thread(scan_classic, args.seconds, args.verbose)
         # Merge: prefer BLE fields when same MAC appears (rare across transports but possible on some stacks)
         for addr, rec in classic_records.items():
             if addr in all_records:
@@ -236,7 +401,7 @@ async def main_async():
         print(f"[i] Total unique devices: {len(all_records)}")
 
     # Outputs
-    ts = datetime.now().strftime("%Y%m%d-%H%M%S")
+    ts = time.strftime("%Y%m%d-%H%M%S")
     if args.json_path:
         write_json(args.json_path, all_records)
         print(f"[✓] Wrote JSON: {args.json_path}")